@@ -23,6 +23,10 @@ import numpy
 
 logger = logging.getLogger(__name__)
 
+# Constants of the log-parabola CSF model
+_LOG10_2 = math.log10(2.0)
+_FOUR_LOG10_2 = 4.0 * _LOG10_2
+
 class Stimulus:
 	def __init__(self, contrast, frequency):
 		self.contrast = contrast
@@ -73,7 +77,13 @@ def csf_unmapped(parameters, frequency):
 
 	return csf(peakSensitivity, peakFrequency, logBandwidth, delta, frequency)
 
-def csf(peakSensitivity, peakFrequency, logBandwidth, delta, frequency):
+def csf(peakSensitivity, peakFrequency, logBandwidth, delta, frequency, out=None):
+	'''Log sensitivity at each frequency (m, in cycles per degree)
+
+		Parameters are either log-unit vectors (n), as from mapCSFParams,
+		or scalars in linear units (as aulcsf passes them), which are logged here
+		If out is given, the (n, m) result is written into it
+	'''
 	frequency = numpy.log10(frequency)
 
 	if not isinstance(peakSensitivity, Iterable):
@@ -86,22 +96,21 @@ def csf(peakSensitivity, peakFrequency, logBandwidth, delta, frequency):
 
 		frequency = numpy.array([[frequency]])
 
-	n = len(peakSensitivity)
-	m = len(frequency[0])
+	# Let broadcasting form the (n, m) outer product rather than materializing copies
+	frequency = frequency.reshape(1, -1)
 
-	frequency = frequency.repeat(n, 0)
+	peakFrequency = peakFrequency[:,numpy.newaxis]
+	peakSensitivity = peakSensitivity[:,numpy.newaxis]
+	delta = delta[:,numpy.newaxis]
 
-	peakFrequency = peakFrequency[:,numpy.newaxis].repeat(m,1)
-	peakSensitivity = peakSensitivity[:,numpy.newaxis].repeat(m,1)
-	delta = delta[:,numpy.newaxis].repeat(m,1)
+	divisor = _LOG10_2+logBandwidth
+	divisor = divisor[:,numpy.newaxis]
+	truncation = (_FOUR_LOG10_2 * numpy.power(numpy.divide(frequency-peakFrequency, divisor), 2))
 
-	divisor = numpy.log10(2)+logBandwidth
-	divisor = divisor[:,numpy.newaxis].repeat(m,1)
-	truncation = (4 * numpy.log10(2) * numpy.power(numpy.divide(frequency-peakFrequency, divisor), 2))
+	logSensitivity = numpy.maximum(0, peakSensitivity - truncation, out=out)
 
-	logSensitivity = numpy.maximum(0, peakSensitivity - truncation)
-	Scutoff = numpy.maximum(logSensitivity, peakSensitivity-delta)
-	logSensitivity[frequency<peakFrequency] = Scutoff[frequency<peakFrequency]
+	# Below the peak frequency, truncate at peakSensitivity-delta (in place, only where needed)
+	numpy.maximum(logSensitivity, peakSensitivity-delta, out=logSensitivity, where=frequency<peakFrequency)
 
 	return logSensitivity
 
@@ -153,7 +162,9 @@ def mapCSFParams(params, exponify=False):
 	return numpy.stack((peakSensitivity, peakFrequency, bandwidth, delta))
 
 def entropy(p):
-	return numpy.multiply(-p, numpy.log(p)) - numpy.multiply(1-p, numpy.log(1-p))
+	'''Binary entropy of probabilities p, taking 0*log(0) as 0 so p=0 and p=1 stay finite'''
+	q = 1-p
+	return -(p*numpy.log(numpy.where(p > 0, p, 1)) + q*numpy.log(numpy.where(q > 0, q, 1)))
 
 class QuickCSFEstimator():
 	def __init__(self, stimulusSpace=None):
@@ -188,16 +199,44 @@ class QuickCSFEstimator():
 		self.parameterRanges = [len(pSpace) for pSpace in self.parameterSpace]
 		self.paramComboCount = numpy.prod(self.parameterRanges)
 
-		self.d = 0.5
-		self.sig = 0.25
+		# Flattened indices and their inflated equivalents never change, so build them once
+		self._allParamIndices = numpy.arange(self.paramComboCount).reshape(-1,1)
+		self._allStimIndices = numpy.arange(self.stimComboCount).reshape(-1,1)
+		self._paramIndexTable = self._inflate(self._allParamIndices, self.parameterRanges)
+		self._stimIndexTable = self._inflate(self._allStimIndices, self.stimulusRanges)
+
+		# CSF values, one row per parameter combination (filled on first use by _cachedCSF)
+		# The large per-parameter arrays are single precision, which is plenty for psychophysics
+		self._csfCache = None
+
+		# Reusable fixed-shape output arrays for _pmeas (see _scratchBuffer)
+		self._scratchBuffers = {}
 
-		# Probabilities (initialize all of them to equal values that sum to 1)
-		self.probabilities = numpy.ones((self.paramComboCount,1))/self.paramComboCount
+		# Log sensitivity of each contrast in the stimulus space
+		self._sensitivitySpace = numpy.log10(numpy.divide(1, self.stimulusSpace[0])).astype(numpy.float32)
+
+		self.d = numpy.float32(0.5)
+		self.sig = numpy.float32(0.25)
+
+		# Log probabilities (initialize all of them to equal values that sum to 1)
+		# Normalized probabilities and their CDF are only materialized when read
+		self.logProbabilities = numpy.full(self.paramComboCount, -numpy.log(self.paramComboCount))
+		self._probabilities = None
+		self._cumulativeProbabilities = None
 
 		self.currentStimulusIndex = None
 		self.currentStimParamIndices = None
 		self.responseHistory = []
 
+	@property
+	def probabilities(self):
+		'''Normalized parameter probabilities (1-D, one per parameter combination), materialized from logProbabilities'''
+		if self._probabilities is None:
+			probabilities = numpy.exp((self.logProbabilities - self.logProbabilities.max()).astype(numpy.float32))
+			self._probabilities = probabilities / numpy.sum(probabilities)
+
+		return self._probabilities
+
 	def next(self):
 		'''Determine the next stimulus to be tested'''
 
@@ -206,28 +245,35 @@ class QuickCSFEstimator():
 		# more probable stim params have higher weight of being sampled
 		randomSampleCount = 100
 
-		paramIndicies = numpy.random.choice(
-			numpy.arange(self.paramComboCount),
-			randomSampleCount,
-			p=self.probabilities[:,0]
+		# (inverse transform sampling against a CDF cached until the next markResponse)
+		if self._cumulativeProbabilities is None:
+			self._cumulativeProbabilities = numpy.cumsum(self.probabilities, dtype=numpy.float64)
+
+		paramIndicies = numpy.searchsorted(
+			self._cumulativeProbabilities,
+			numpy.random.random(randomSampleCount) * self._cumulativeProbabilities[-1],
+			side='right'
 		).reshape(-1, 1)
 
 		# calculate probabilities for all stimuli with all samples of parameters
-		# @TODO: parallelize this
-		stimIndicies = numpy.arange(self.stimComboCount).reshape(-1,1)
-		p = self._pmeas(paramIndicies, stimIndicies)
+		p = self._pmeas(
+			paramIndicies,
+			self._allStimIndices,
+			out=self._scratchBuffer('samples', (randomSampleCount, self.stimComboCount))
+		)
 
 		# Determine amount of information to be gained
-		pbar = sum(p)/randomSampleCount
-		hbar = sum(entropy(p))/randomSampleCount
+		pbar = p.sum(axis=0)/randomSampleCount
+		hbar = entropy(p).sum(axis=0)/randomSampleCount
 		gain = entropy(pbar)-hbar
 
-		# Sort by gain descending (highest gain first)
-		sortMap = numpy.argsort(-gain)
+		# Find the highest 10% info givers (unordered; no need for a full sort)
+		topCount = max(1, self.stimComboCount // 10)
+		topIndices = numpy.argpartition(-gain, topCount-1)[:topCount]
 
-		# select a random one from the highest 10% info givers
-		randIndex = int(numpy.random.rand()*self.stimComboCount/10)
-		self.currentStimulusIndex = numpy.array([[sortMap[randIndex]]])
+		# select a random one from them
+		randIndex = numpy.random.randint(topCount)
+		self.currentStimulusIndex = numpy.array([[topIndices[randIndex]]])
 		self.currentStimParamIndices = self.inflateStimulusIndex(self.currentStimulusIndex)
 
 		return Stimulus(
@@ -236,52 +282,91 @@ class QuickCSFEstimator():
 		)
 
 	def _inflate(self, index, ranges):
-		'''Inflates a flattened list of indexes into lists of lists of indexes'''
-
-		dimensions = len(ranges)
-		indices = index.repeat(dimensions, 1)
-
-		for i in range(dimensions-1):
-			indices[:, i] = numpy.mod(indices[:, -1], ranges[i])
-			indices[:, -1] = numpy.floor(indices[:, -1] / ranges[i])
+		'''Inflates a flattened list of indexes into lists of lists of indexes
 
-		return indices
+			The first dimension varies fastest (column-major order)
+		'''
+		return numpy.stack(numpy.unravel_index(index.ravel(), tuple(ranges), order='F'), axis=1)
 
 	def inflateParameterIndex(self, parameterIndex):
 		'''Converts a flattened parameter index into its 4 constituent indices'''
-		return self._inflate(parameterIndex, self.parameterRanges)
+		if parameterIndex is self._allParamIndices:
+			return self._paramIndexTable
+
+		return self._paramIndexTable[parameterIndex.ravel()]
 
 	def inflateStimulusIndex(self, stimulusIndex):
 		'''Converts a flattened stimulus index into its 2 constituent indices'''
-		return self._inflate(stimulusIndex, self.stimulusRanges)
+		if stimulusIndex is self._allStimIndices:
+			return self._stimIndexTable
+
+		return self._stimIndexTable[stimulusIndex.ravel()]
+
+	def _cachedCSF(self, parameterIndex):
+		'''CSF values across the whole frequency space for flattened parameter indices
+
+			The CSF is deterministic in its parameters, so it is computed for every combination once
+		'''
+		if self._csfCache is None:
+			self._csfCache = numpy.empty((self.paramComboCount, self.stimulusRanges[1]), dtype=numpy.float32)
+			csf(*mapCSFParams(self._paramIndexTable), self.stimulusSpace[1].reshape(1,-1), out=self._csfCache)
+
+		if parameterIndex is self._allParamIndices:
+			return self._csfCache
 
-	def _pmeas(self, parameterIndex, stimulusIndex=None):
-		'''Calculates probability for a configuration of parameters'''
+		return self._csfCache[parameterIndex.ravel()]
+
+	def _scratchBuffer(self, name, shape):
+		'''A reusable float32 array, only reallocated when the requested shape changes'''
+		buffer = self._scratchBuffers.get(name)
+		if buffer is None or buffer.shape != shape:
+			buffer = numpy.empty(shape, dtype=numpy.float32)
+			self._scratchBuffers[name] = buffer
+
+		return buffer
+
+	def _pmeas(self, parameterIndex, stimulusIndex=None, out=None):
+		'''Calculates probability for a configuration of parameters
+
+			If out is given, the (parameters, stimuli) result is written into it
+		'''
 
 		# Check if param list is a single-dimension
 		if parameterIndex.shape[1] == 1:
-			# If it's a single dimension, we need to unroll it into 4 separate ones
-			parameters = self.inflateParameterIndex(parameterIndex)
+			# If it's a single dimension, CSF values can come from the cache
+			csfValues = self._cachedCSF(parameterIndex)
 		else:
-			parameters = parameterIndex
+			csfValues = csf_unmapped(parameterIndex, self.stimulusSpace[1].reshape(1,-1))
 
 		# Unroll into separate rows
 		if stimulusIndex is None:
 			stimulusIndex = self.currentStimulusIndex
 
-		stimulusIndices = self.inflateStimulusIndex(stimulusIndex)
+		if stimulusIndex is self._allStimIndices:
+			# Every stimulus, with contrast varying fastest: broadcast (n, frequencies, 1) CSF values
+			# against (1, 1, contrasts) sensitivities instead of copying CSF values per contrast
+			csfValues = csfValues[:, :, numpy.newaxis]
+			sensitivity = self._sensitivitySpace.reshape(1, 1, -1)
+		else:
+			stimulusIndices = self.inflateStimulusIndex(stimulusIndex)
 
-		frequencies = self.stimulusSpace[1][stimulusIndices[:,1]].reshape(1,-1)
-		csfValues = csf_unmapped(parameters, frequencies)
+			# Pick out the frequency of each stimulus from the (n, frequencies) CSF values
+			csfValues = csfValues[:, stimulusIndices[:,1]]
+			sensitivity = self._sensitivitySpace[stimulusIndices[:,0]].reshape(1, -1)
 
-		# Make vector of sensitivities
-		contrast = self.stimulusSpace[0][stimulusIndices[:,0]]
+		if out is not None:
+			# View the output in the same (possibly 3-D) shape as the broadcast inputs
+			out = out.reshape(numpy.broadcast(csfValues, sensitivity).shape)
 
-		sensitivity = numpy.log10(
-			numpy.ones((parameters.shape[0], 1)) * numpy.divide(1, contrast)
-		)
+		# 1 - d/(1+exp((csfValues-sensitivity)/sig)), reusing a single buffer
+		p = numpy.subtract(csfValues, sensitivity, out=out)
+		numpy.divide(p, self.sig, out=p)
+		numpy.exp(p, out=p)
+		numpy.add(p, 1, out=p)
+		numpy.divide(self.d, p, out=p)
+		numpy.subtract(1, p, out=p)
 
-		return 1 - numpy.divide(self.d, 1+numpy.exp((csfValues-sensitivity) / self.sig))
+		return p.reshape(p.shape[0], -1)
 
 	def markResponse(self, response, stimIndex=None):
 		'''Record an observer's response and update parameter probabilities
@@ -295,43 +380,64 @@ class QuickCSFEstimator():
 
 		if stimIndex is None:
 			stimIndex = self.currentStimulusIndex
-			stimIndices = self.inflateStimulusIndex(stimIndex)
 
-		contrast = self.stimulusSpace[0][stimIndices[:,0]][0]
-		frequency = self.stimulusSpace[1][stimIndices[:,1]][0]
+		self.markResponseBatch(stimIndex, [response])
 
-		logger.info(f'Marking response {stimIndex}[c={contrast},f={frequency}] = {response}')
+	def markResponseBatch(self, stimIndices, responses):
+		'''Record several observer responses and update parameter probabilities in one pass
 
-		self.responseHistory.append([
-			[contrast, frequency],
-			response
-		])
+			Args:
+				stimIndices: flattened stimulus indices, one per response
+				responses: observer responses, in the same order as stimIndices
+		'''
 
-		# get probability for this stimulus
-		pm = self._pmeas(
-			numpy.arange(self.paramComboCount)[:,numpy.newaxis],
-			stimIndex
-		)
+		stimIndices = numpy.asarray(stimIndices, dtype=int).reshape(-1, 1)
+		responses = numpy.asarray(responses).reshape(-1)
 
-		if response:
-			self.probabilities = numpy.multiply(self.probabilities, pm)
+		if len(stimIndices) != len(responses):
+			raise ValueError(f'Got {len(stimIndices)} stimulus indices but {len(responses)} responses')
+
+		if len(stimIndices) == 0:
+			return
+
+		# get probabilities for these stimuli (one column per response)
+		# Single trials (markResponse) reuse one buffer; wider batches get a temporary array
+		# so the estimator doesn't hold on to the largest batch it has ever seen
+		if len(stimIndices) == 1:
+			out = self._scratchBuffer('response', (self.paramComboCount, 1))
 		else:
-			self.probabilities = numpy.multiply(self.probabilities, (1-pm))
+			out = None
 
-		# Normalize probabilities
-		self.probabilities = self.probabilities/numpy.sum(self.probabilities)
+		pm = self._pmeas(self._allParamIndices, stimIndices, out=out)
 
-	def margin(self, parameterIndex):
-		params = numpy.arange(self.paramComboCount).reshape(-1,1)
-		params = self.inflateParameterIndex(params)
+		logLikelihood = numpy.log(numpy.where(responses.astype(bool).reshape(1, -1), pm, 1-pm))
+
+		# Nothing below can fail, so history and probabilities stay in step
+		inflatedIndices = self.inflateStimulusIndex(stimIndices)
+		for stimIndex, (contrastIndex, frequencyIndex), response in zip(stimIndices[:,0], inflatedIndices, responses.tolist()):
+			contrast = self.stimulusSpace[0][contrastIndex]
+			frequency = self.stimulusSpace[1][frequencyIndex]
+
+			logger.info(f'Marking response {stimIndex}[c={contrast},f={frequency}] = {response}')
 
-		pMarg = numpy.zeros((self.parameterRanges[parameterIndex], 1))
-		for parameterCalcIndex in range(self.parameterRanges[parameterIndex]):
-			# Filter out all the other parameters' values
-			parameterFilterMask = (params[:, parameterIndex] == parameterCalcIndex).reshape(-1, 1)
-			pMarg[parameterCalcIndex] = numpy.sum(numpy.multiply(self.probabilities, parameterFilterMask))
+			self.responseHistory.append([
+				[contrast, frequency],
+				response
+			])
 
-		return pMarg
+		# Accumulate in log-space; normalization is deferred until probabilities are read
+		self.logProbabilities += logLikelihood.sum(axis=1)
+
+		self._probabilities = None
+		self._cumulativeProbabilities = None
+
+	def margin(self, parameterIndex):
+		'''Marginal probability of each value of a single parameter'''
+		return numpy.bincount(
+			self._paramIndexTable[:, parameterIndex],
+			weights=self.probabilities,
+			minlength=self.parameterRanges[parameterIndex]
+		).reshape(-1, 1)
 
 	def getResults(self, leaveAsIndices=False):
 		'''Calculate an estimate of all 4 parameters based on their probabilities
@@ -341,14 +447,15 @@ class QuickCSFEstimator():
 					if True, will output indices, which can be converted with `mapCSFParams()`
 		'''
 
-		params = numpy.arange(self.paramComboCount).reshape(-1,1)
-		params = self.inflateParameterIndex(params)
+		# Joint distribution with one axis per parameter (first varies fastest, as in _inflate)
+		jointProbabilities = self.probabilities.reshape(self.parameterRanges, order='F')
 
 		# Calculate a mean value for each of the estimated parameters
 		estimatedParamMeans = numpy.zeros(len(self.parameterRanges))
 		for n, parameterRange in enumerate(self.parameterRanges):
-			pMarg = self.margin(n)
-			estimatedParamMeans[n] = numpy.dot(pMarg.T, numpy.arange(parameterRange))
+			otherAxes = tuple(i for i in range(len(self.parameterRanges)) if i != n)
+			pMarg = jointProbabilities.sum(axis=otherAxes, dtype=numpy.float64)
+			estimatedParamMeans[n] = numpy.dot(pMarg, numpy.arange(parameterRange))
 
 		results = estimatedParamMeans.reshape(1,len(self.parameterRanges))
 
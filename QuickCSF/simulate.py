@@ -107,8 +107,8 @@ def entropyPlot(qcsf):
 
 	p = qcsf._pmeas(params, stims)
 
-	pbar = sum(p)/len(params)
-	hbar = sum(QuickCSF.entropy(p))/len(params)
+	pbar = p.sum(axis=0)/len(params)
+	hbar = QuickCSF.entropy(p).sum(axis=0)/len(params)
 	gain = QuickCSF.entropy(pbar)-hbar
 
 